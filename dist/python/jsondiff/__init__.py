@@ -8,15 +8,16 @@ Copyright (c) 2011 Simperium, Inc. All rights reserved.
 import sys
 import os
 import copy
+import time
 import json
+import bisect
+import urllib
+import functools
+import threading
+import collections
+import multiprocessing
 import dmp_patch
 
-from diffmatchpatch import diff_match_patch
-
-dmp_patch.monkey()
-
-DMP = diff_match_patch()
-
 OTYPE_MAP = {
     'replace'   : [ '+', '-', 'r' ],
     'list'      : [ '+', '-', 'L' ],
@@ -32,60 +33,388 @@ def same_type(a, b):
         return True
     return type(a) == type(b)
 
+SCOPE = threading.local()
+
+# the differ running the current call, see differ.run
+def current_differ():
+    return getattr(SCOPE, 'differ', None) or DEFAULT
+
+# each diff gets the differ's timeout, and no more than its budget has left
+def text_diffs(a, b, checklines=True):
+    dmp = current_differ().dmp
+    deadline = getattr(SCOPE, 'deadline', None)
+    if deadline is not None and dmp.Diff_Timeout > 0:
+        deadline = min(deadline, time.time() + dmp.Diff_Timeout)
+    return dmp.diff_main(a, b, checklines, deadline)
+
+# memoizes fingerprints of containers and the results of comparing pairs of
+# them for the duration of the outermost decorated call; every container
+# memoized is kept alive meanwhile so its id can't be reused
+def fingerprinted(f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if getattr(SCOPE, 'fingerprints', None) is not None:
+            return f(*args, **kwargs)
+        SCOPE.fingerprints = {}
+        SCOPE.compared = {}
+        SCOPE.kept = {}
+        try:
+            return f(*args, **kwargs)
+        finally:
+            SCOPE.fingerprints = None
+            SCOPE.compared = None
+            SCOPE.kept = None
+    return wrapper
+
+# records the time of every diff op made, by op type
+def recorded(f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        stats = current_differ().stats
+        if stats is None:
+            return f(*args, **kwargs)
+        started = op_started()
+        result = {}
+        try:
+            result = f(*args, **kwargs)
+        finally:
+            # a failed op isn't recorded but still restores the nesting
+            op_finished(stats, 'diff', result.get('o'), started)
+        return result
+    return wrapper
+
+# time spent in nested ops is kept apart so each op records only its own
+def op_started():
+    nested = getattr(SCOPE, 'nested', 0)
+    SCOPE.nested = 0
+    return time.time(), nested
+
+def op_finished(stats, phase, otype, started):
+    start, nested = started
+    elapsed = time.time() - start
+    if otype is not None:
+        stats.record(phase, otype, elapsed - SCOPE.nested)
+    SCOPE.nested = nested + elapsed
+
+# collects call counts and seconds per (phase, op type), phase being one of
+# 'diff', 'apply' or 'transform'; the seconds of an op don't include those
+# of the ops nested in it
+# any object with a record(phase, otype, seconds) method can be given to a
+# differ instead, e.g. to forward them to a metrics system
+class op_stats:
+    def __init__(self):
+        self.calls = collections.defaultdict(int)
+        self.seconds = collections.defaultdict(float)
+        self.lock = threading.Lock()
+
+    def record(self, phase, otype, seconds):
+        with self.lock:
+            self.calls[(phase, otype)] += 1
+            self.seconds[(phase, otype)] += seconds
+
+    # [(phase, otype, calls, seconds)], most expensive first
+    def report(self):
+        with self.lock:
+            rows = [k + (self.calls[k], self.seconds[k]) for k in self.calls]
+        return sorted(rows, key=lambda r: r[3], reverse=True)
+
+# structural hash of a json value, equal for any a, b where equals(a, b)
+def fingerprint(a):
+    if type(a) == dict or type(a) == list:
+        cache = getattr(SCOPE, 'fingerprints', None)
+        if cache is not None and id(a) in cache:
+            return cache[id(a)][0]
+        if type(a) == dict:
+            h = hash(('O', frozenset((k, fingerprint(v)) for k, v in a.iteritems())))
+        else:
+            h = hash(('L', tuple(fingerprint(v) for v in a)))
+        if cache is not None:
+            cache[id(a)] = (h, a)
+        return h
+    elif type(a) == float:
+        return hash(('f', a))
+    elif type(a) == long:
+        return hash(('l', a))
+    return hash(a)
+
 def equals(a, b):
+    if a is b:
+        return True
     if not same_type(a, b):
         return False
     if type(a) == bool and type(b) == int:
         return int(a) == b
     if type(a) == int and type(b) == bool:
         return a == int(b)
-    if type(a) == list:
-        return list_equals(a, b)
-    elif type(a) == dict:
-        return object_equals(a, b)
+    if type(a) == list or type(a) == dict:
+        fingerprints = getattr(SCOPE, 'fingerprints', None)
+        if fingerprints is None:
+            if type(a) == list:
+                return list_equals(a, b)
+            return object_equals(a, b)
+        # fingerprints already taken settle a mismatch for free, but taking
+        # them costs more than a walk, so comparisons are remembered instead
+        # and a subtree is walked about once per scope
+        if id(a) in fingerprints and id(b) in fingerprints:
+            if fingerprints[id(a)][0] != fingerprints[id(b)][0]:
+                return False
+        key = (id(a), id(b))
+        if key in SCOPE.compared:
+            return SCOPE.compared[key]
+        if type(a) == list:
+            result = list_equals(a, b)
+        else:
+            result = object_equals(a, b)
+        SCOPE.compared[key] = result
+        SCOPE.kept[id(a)] = a
+        SCOPE.kept[id(b)] = b
+        return result
     else:
         return a == b
 
+# raised by transform_patches for history.transform to fall back on
+class patch_conflict(Exception):
+    pass
+
+# apply the patches of the op being transformed, in strict scopes raising
+# patch_conflict rather than dropping those that don't apply
+def transform_patches(patches, text):
+    text, applied = current_differ().dmp.patch_apply(patches, text)
+    if getattr(SCOPE, 'strict', False) and not all(applied):
+        raise patch_conflict()
+    return text
+
+# apply a string delta, slicing directly when it was made against text and
+# only building and fuzzy matching patches when it wasn't
+def patch_text(text, delta):
+    result = dmp_patch.apply_delta(text, delta)
+    if result is None:
+        dmp = current_differ().dmp
+        diffs = dmp.diff_fromDelta(text, delta)
+        patches = dmp.patch_make(text, diffs)
+        result = dmp.patch_apply(patches, text)[0]
+    return result
+
+def serialize_line(e):
+    return json.dumps(e, separators=(',', ':'))+'\n'
+
+# bounded LRU of serialized list_dmp lines keyed by element identity
+# entries hold the element so its id can't be reused while cached, cached
+# elements must not be modified in place
+class line_cache:
+    def __init__(self, size=10000):
+        self.size = size
+        self.lines = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, e):
+        with self.lock:
+            entry = self.lines.pop(id(e), None)
+            if entry is None or entry[0] is not e:
+                entry = (e, serialize_line(e))
+            self.lines[id(e)] = entry
+            if len(self.lines) > self.size:
+                self.lines.popitem(last=False)
+            return entry[1]
+
+# cache defaults to the line cache of the current differ, if it has one
+def serialize_lines(a, cache=None):
+    if cache is None:
+        cache = current_differ().lines
+    if cache is None:
+        return [serialize_line(e) for e in a]
+    return [cache.get(e) for e in a]
+
 def serialize_to_text(a):
-    return ''.join([json.dumps(s, separators=(',', ':'))+'\n' for s in a])
+    return ''.join(serialize_lines(a))
 
 def text_to_list(s):
     return [json.loads(e) for e in s.split('\n') if len(e)]
 
-def list_diff_dmp(a, b, policy=None):
-    atext = serialize_to_text(a)
-    btext = serialize_to_text(b)
+def text_to_lines(s):
+    lines = [l+'\n' for l in s.split('\n')]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+# line mode delta between two lists of serialized lines
+# lines are only joined within changed blocks, which are rediffed by character
+# unless by_char is False, then they are deleted and inserted as whole lines
+def lines_delta(alines, blines, by_char=True):
+    dmp = current_differ().dmp
+    tokens = []
+    def add(op, v):
+        if tokens and tokens[-1][0] == op:
+            tokens[-1][1] += v
+        else:
+            tokens.append([op, v])
+
+    def rediff(atext, btext):
+        diffs = text_diffs(atext, btext, False)
+        if len(diffs) > 2:
+            dmp.diff_cleanupEfficiency(diffs)
+        for op, text in diffs:
+            if op == dmp.DIFF_INSERT:
+                add(op, text)
+            else:
+                add(op, dmp_patch.length_ucs2(text))
+
+    i = 0
+    j = 0
+    for mi, mj in lcs_matches(alines, blines) + [(len(alines), len(blines))]:
+        if i < mi and j < mj and not by_char:
+            add(dmp.DIFF_DELETE, sum(len(l) for l in alines[i:mi]))
+            add(dmp.DIFF_INSERT, ''.join(blines[j:mj]))
+        elif i < mi and j < mj and mi - i == mj - j:
+            # items changed in place, each is rediffed against its old self
+            for n in range(mi - i):
+                rediff(alines[i+n], blines[j+n])
+        elif i < mi and j < mj:
+            rediff(''.join(alines[i:mi]), ''.join(blines[j:mj]))
+        elif i < mi:
+            add(dmp.DIFF_DELETE, sum(len(l) for l in alines[i:mi]))
+        elif j < mj:
+            add(dmp.DIFF_INSERT, ''.join(blines[j:mj]))
+        if mi < len(alines):
+            add(dmp.DIFF_EQUAL, len(alines[mi]))
+        i = mi + 1
+        j = mj + 1
+
+    delta = []
+    for op, v in tokens:
+        if op == dmp.DIFF_INSERT:
+            delta.append(dmp_patch.delta_insert(v))
+        elif op == dmp.DIFF_DELETE:
+            delta.append("-%d" % v)
+        else:
+            delta.append("=%d" % v)
+    return "\t".join(delta)
+
+# apply a line mode delta made against exactly lines (serialized items) by
+# splicing items, only the lines the delta touches are parsed again
+# returns None if the delta doesn't fit lines
+def apply_lines_delta(items, lines, delta):
+    try:
+        tokens = [t for t in str(delta).split('\t') if t]
+    except UnicodeEncodeError:
+        return None
+    ends = []
+    total = 0
+    for l in lines:
+        total += len(l)
+        ends.append(total)
+    for t in tokens:
+        if t[0] == '=' or t[0] == '-':
+            if not t[1:].isdigit():
+                return None
+            total -= int(t[1:])
+        elif t[0] != '+':
+            return None
+    if total != 0:
+        return None
+
+    result = []
+    pending = []
+    def flush():
+        if pending and pending[-1].endswith('\n'):
+            result.extend(text_to_list(''.join(pending)))
+            del pending[:]
 
-    diffs = DMP.diff_lineMode(atext, btext, 0.1)
-    DMP.diff_cleanupEfficiency(diffs)
-    delta = DMP.diff_toDelta(diffs)
-    return delta
+    pos = 0
+    for t in tokens:
+        if t[0] == '+':
+            pending.append(urllib.unquote(t[1:]).decode('utf-8'))
+            flush()
+            continue
+        end = pos + int(t[1:])
+        while t[0] == '=' and pos < end:
+            i = bisect.bisect_right(ends, pos)
+            start = ends[i-1] if i else 0
+            k = bisect.bisect_right(ends, end)
+            if pos == start and not pending and k > i:
+                # whole lines are kept as they are
+                result.extend(items[i:k])
+                pos = ends[k-1]
+                continue
+            stop = min(end, ends[i])
+            pending.append(lines[i][pos-start:stop-start])
+            flush()
+            pos = stop
+        pos = end
+    result.extend(text_to_list(''.join(pending)))
+    return result
 
-def apply_list_diff_dmp(s, delta):
-    ptext = serialize_to_text(s)
+def list_diff_dmp(a, b, policy=None, cache=None):
+    return lines_delta(serialize_lines(a, cache), serialize_lines(b, cache))
 
-    diffs = DMP.diff_fromDelta(ptext, delta)
-    patches = DMP.patch_make(ptext, diffs)
-    result = DMP.patch_apply(patches, ptext)
+# untouched items of s are shared with the result
+def apply_list_diff_dmp(s, delta, cache=None):
+    lines = serialize_lines(s, cache)
+    result = apply_lines_delta(s, lines, delta)
+    if result is None:
+        result = text_to_list(patch_text(''.join(lines), delta))
+    return result
 
-    return text_to_list(result[0])
+# one character per distinct line of each list of lines, from first up, or
+# None if there are more distinct lines than characters outside the surrogates
+def lines_to_chars(texts, first=1):
+    codes = {}
+    lines = {}
+    result = []
+    for text in texts:
+        chars = []
+        for line in text:
+            c = codes.get(line)
+            if c is None:
+                n = len(lines) + first
+                if n >= 0xD800:
+                    n += 0x800
+                if n > 0xFFFF:
+                    return None
+                c = codes[line] = unichr(n)
+                lines[c] = line
+            chars.append(c)
+        result.append(''.join(chars))
+    return result, lines
 
-def transform_list_diff_dmp(ad, bd, s, policy=None):
-    stext = serialize_to_text(s)
+# whether the lines that aren't known to be serialized items still decode
+def lines_decode(lines, known):
+    for l in lines:
+        if l in known or not l.strip('\n'):
+            continue
+        try:
+            json.loads(l)
+        except ValueError:
+            return False
+    return True
 
-    a_patches = DMP.patch_make(stext, DMP.diff_fromDelta(stext, ad))
-    b_patches = DMP.patch_make(stext, DMP.diff_fromDelta(stext, bd))
+# the patches of ad are fuzzy matched against the result of bd as one text,
+# if that splits lines into invalid json they are redone with one character
+# per line, so that the patches can only move whole lines
+# the result is a line granular delta against the result of bd
+def transform_list_diff_dmp(ad, bd, s, policy=None, cache=None):
+    dmp = current_differ().dmp
+    slines = serialize_lines(s, cache)
+    stext = ''.join(slines)
+    b_lines = text_to_lines(patch_text(stext, bd))
 
-    b_text = DMP.patch_apply(b_patches, stext)[0]
-    ab_text = DMP.patch_apply(a_patches, b_text)[0]
-    if ab_text != b_text:
-      diffs = DMP.diff_lineMode(b_text, ab_text, 0.1)
-      if len(diffs) > 2:
-        DMP.diff_cleanupEfficiency(diffs)
-      if len(diffs) > 0:
-        return DMP.diff_toDelta(diffs)
+    a_patches = dmp.patch_make(stext, dmp.diff_fromDelta(stext, ad))
+    ab_lines = text_to_lines(transform_patches(a_patches, ''.join(b_lines)))
+    if not lines_decode(ab_lines, set(b_lines)):
+        a_lines = text_to_lines(patch_text(stext, ad))
+        # patch_apply pads the text with the characters up to Patch_Margin
+        encoded = lines_to_chars([slines, a_lines, b_lines], dmp.Patch_Margin + 1)
+        if encoded is not None:
+            (schars, achars, bchars), lines = encoded
+            a_patches = dmp.patch_make(schars, achars)
+            # patches fuzzy matched at the ends can leave some of the padding
+            ab_lines = [lines[c] for c in transform_patches(a_patches, bchars) if c in lines]
+    if ab_lines != b_lines:
+        return lines_delta(b_lines, ab_lines, False)
     return ""
 
+@fingerprinted
 def common_prefix(a, b):
     maxl = min(len(a), len(b))
     for i in range(maxl):
@@ -93,6 +422,7 @@ def common_prefix(a, b):
             return i
     return maxl
 
+@fingerprinted
 def common_suffix(a, b):
     maxl = min(len(a), len(b))
     maxa = len(a)
@@ -102,38 +432,225 @@ def common_suffix(a, b):
             return i
     return maxl
 
+# returns the container ops get applied to and the mode for nested ops
+# a deep copy is only taken once, nested ops then work on the copy in place
+def apply_target(a, mode):
+    if mode == 'copy':
+        # deepcopy keeps aliased subtrees aliased, so nested ops still
+        # have to copy the path they change
+        return copy.deepcopy(a), 'share'
+    elif mode == 'share':
+        return copy.copy(a), 'share'
+    elif mode == 'inplace':
+        return a, 'inplace'
+    raise ValueError("Invalid apply mode: %s" % mode)
+
 # a = list, c = list of ops to apply to a
-def apply_list_diff(a, c):
-    deleted = []
-    ac = copy.deepcopy(a)
-    for i,o in sorted(c.iteritems()):
-        # shift i
-        i = int(i)
-        si = i - len(filter(lambda x: x <= i, deleted))
-        sp = len(filter(lambda x: x <= i, deleted))
+# mode: 'copy' returns a deep copy, 'share' copies only the changed path and
+# shares untouched subtrees with a, 'inplace' modifies a itself
+def apply_list_diff(a, c, mode='copy'):
+    ac, mode = apply_target(a, mode)
+    ops = sorted(((int(i), o) for i, o in c.iteritems()), key=lambda x: x[0])
+
+    # ops are visited in index order, so every earlier delete shifts i
+    # left by one and the result can be built in a single pass
+    stats = current_differ().stats
+    result = []
+    pos = 0
+    deleted = 0
+    for i,o in ops:
+        if stats is not None:
+            started = op_started()
+        n = min(i - deleted - len(result), len(ac) - pos)
+        if n > 0:
+            result.extend(ac[pos:pos+n])
+            pos += n
         if o['o'] == '+':
-            ac.insert(si, o['v'])
+            result.append(o['v'])
         elif o['o'] == '-':
-            ac.pop(si)
-            deleted.append(i)
-        elif o['o'] == 'r':
-            ac[si] = o['v']
-        elif o['o'] == 'I':
-            ac[si] += o['v']
-        elif o['o'] == 'L':
-            ac[si] = apply_list_diff(ac[si], o['v'])
-        elif o['o'] == 'dL':
-            ac[si] = apply_list_diff_dmp(ac[si], o['v'])
-        elif o['o'] == 'O':
-            ac[si] = apply_object_diff(ac[si], o['v'])
-        elif o['o'] == 'd':
-            diffs = DMP.diff_fromDelta(ac[si], o['v'])
-            patches = DMP.patch_make(ac[si], diffs)
-            result = DMP.patch_apply(patches, ac[si])
-            ac[si] = result[0]
+            if pos >= len(ac):
+                raise IndexError("delete index out of range: %d" % i)
+            pos += 1
+            deleted += 1
+        else:
+            v = ac[pos]
+            pos += 1
+            if o['o'] == 'r':
+                v = o['v']
+            elif o['o'] == 'I':
+                v += o['v']
+            elif o['o'] == 'L':
+                v = apply_list_diff(v, o['v'], mode)
+            elif o['o'] == 'dL':
+                v = apply_list_diff_dmp(v, o['v'])
+            elif o['o'] == 'O':
+                v = apply_object_diff(v, o['v'], mode)
+            elif o['o'] == 'd':
+                v = patch_text(v, o['v'])
+            result.append(v)
+        if stats is not None:
+            op_finished(stats, 'apply', o['o'], started)
+    result.extend(ac[pos:])
+    ac[:] = result
     return ac
 
+# edit distance past which lcs_matches stops searching and leaves the
+# changed region unmatched, i.e. diffed as whole runs of - and + ops
+LCS_MAX_EDITS = 1000
+
+# Myers O(ND) diff over two sequences of hashable items, in linear space
+# returns the (i, j) index pairs of a longest common subsequence, or of
+# just the common prefix and suffix if that is more than limit edits away
+def lcs_matches(a, b, limit=LCS_MAX_EDITS):
+    n = len(a)
+    m = len(b)
+    p = 0
+    while p < n and p < m and a[p] == b[p]:
+        p += 1
+    q = 0
+    while q < n-p and q < m-p and a[n-q-1] == b[m-q-1]:
+        q += 1
+
+    # items only one side has can't be matched, leaving them out changes
+    # no match and keeps wholly rewritten regions from being searched
+    ina = set(a[p:n-q])
+    inb = set(b[p:m-q])
+    ia = [i for i in range(p, n-q) if a[i] in inb]
+    ib = [j for j in range(p, m-q) if b[j] in ina]
+    ma = [a[i] for i in ia]
+    mb = [b[j] for j in ib]
+
+    matches = []
+    if not lcs_split(ma, 0, len(ma), mb, 0, len(mb), matches, limit):
+        matches = []
+
+    return [(i, i) for i in range(p)] + [(ia[x], ib[y]) for x, y in matches] + \
+        [(n-i-1, m-i-1) for i in range(q-1, -1, -1)]
+
+# appends the matches between a[alo:ahi] and b[blo:bhi] to matches, in order
+# returns False if they are more than limit edits apart
+def lcs_split(a, alo, ahi, b, blo, bhi, matches, limit=None):
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        matches.append((alo, blo))
+        alo += 1
+        blo += 1
+    suffix = []
+    while alo < ahi and blo < bhi and a[ahi-1] == b[bhi-1]:
+        ahi -= 1
+        bhi -= 1
+        suffix.append((ahi, bhi))
+    if alo < ahi and blo < bhi:
+        # with the ends trimmed at least two edits are left, and the snake
+        # splits them between two strictly smaller problems
+        snake = middle_snake(a, alo, ahi, b, blo, bhi, limit)
+        if snake is None:
+            return False
+        x, y, u, v = snake
+        lcs_split(a, alo, alo+x, b, blo, blo+y, matches)
+        matches.extend((alo+x+i, blo+y+i) for i in range(u-x))
+        lcs_split(a, alo+u, ahi, b, blo+v, bhi, matches)
+    suffix.reverse()
+    matches.extend(suffix)
+    return True
+
+# the snake (x, y) to (u, v), relative to alo and blo, in the middle of a
+# shortest edit script between a[alo:ahi] and b[blo:bhi], searching from both
+# ends at once; None if the script is longer than limit
+def middle_snake(a, alo, ahi, b, blo, bhi, limit=None):
+    n = ahi - alo
+    m = bhi - blo
+    delta = n - m
+    dmax = (n + m + 1) // 2
+    if limit is not None:
+        dmax = min(dmax, (limit + 1) // 2)
+    # forward furthest x per diagonal k at vf[k+fo], backward least x at vb[k+bo]
+    fo = dmax + 1
+    bo = dmax + 1 - delta
+    vf = [0] * (2 * dmax + 3)
+    vb = [0] * (2 * dmax + 3)
+    vb[delta-1+bo] = n
+    for d in range(dmax + 1):
+        for k in range(-d, d+1, 2):
+            if k == -d or (k != d and vf[k-1+fo] < vf[k+1+fo]):
+                x = vf[k+1+fo]
+            else:
+                x = vf[k-1+fo] + 1
+            y = x - k
+            sx = x
+            while x < n and y < m and a[alo+x] == b[blo+y]:
+                x += 1
+                y += 1
+            vf[k+fo] = x
+            if delta % 2 and delta-d < k < delta+d and x >= vb[k+bo]:
+                if limit is not None and 2*d - 1 > limit:
+                    return None
+                return sx, sx - k, x, y
+        for k in range(delta-d, delta+d+1, 2):
+            if k == delta+d or (k != delta-d and vb[k-1+bo] < vb[k+1+bo] - 1):
+                x = vb[k-1+bo]
+            else:
+                x = vb[k+1+bo] - 1
+            y = x - k
+            sx = x
+            while x > 0 and y > 0 and a[alo+x-1] == b[blo+y-1]:
+                x -= 1
+                y -= 1
+            vb[k+bo] = x
+            if not delta % 2 and -d <= k <= d and x <= vf[k+fo]:
+                if limit is not None and 2*d > limit:
+                    return None
+                return x, y, sx, sx - k
+    return None
+
+# ids for the items of a and b, equal only for items that are equal
+# fingerprints pick the candidates, equals settles collisions between them
+def item_ids(a, b):
+    seen = {}
+    def item_id(e):
+        h = fingerprint(e)
+        same = seen.setdefault(h, [])
+        i = 0
+        while i < len(same) and not equals(same[i], e):
+            i += 1
+        if i == len(same):
+            same.append(e)
+        return h, i
+    return [item_id(e) for e in a], [item_id(e) for e in b]
+
+def list_diff_lcs(a, b, policy=None):
+    if policy and 'item' in policy:
+        policy = policy['item']
+    else:
+        policy = None
+
+    c = {}
+    ha, hb = item_ids(a, b)
+    k = 0
+    i = 0
+    j = 0
+    for mi, mj in lcs_matches(ha, hb) + [(len(a), len(b))]:
+        da = mi - i
+        db = mj - j
+        for n in range(max(da, db)):
+            if n < da and n < db:
+                # an unmatched region can still line up equal items
+                if not equals(a[i+n], b[j+n]):
+                    c[str(k)] = diff(a[i+n], b[j+n], policy)
+            elif n < da:
+                c[str(k)] = {'o':'-'}
+            else:
+                c[str(k)] = {'o':'+', 'v':b[j+n]}
+            k = k + 1
+        k = k + 1
+        i = mi + 1
+        j = mj + 1
+    return c
+
+@fingerprinted
 def list_diff(a, b, policy=None):
+    if policy and policy.get('algorithm') == 'lcs':
+        return list_diff_lcs(a, b, policy)
+
     if policy and 'item' in policy:
         policy = policy['item']
     else:
@@ -146,6 +663,12 @@ def list_diff(a, b, policy=None):
     ca = a[cp:-cs+len(a)]
     cb = b[cp:-cs+len(b)]
 
+    # the shift search compares every pair of items, fingerprints taken
+    # first settle most of them at once
+    if len(a) > 1:
+        for e in a + b:
+            fingerprint(e)
+
     sr = 0
     smax = 0
     for i in range(len(a)/2):
@@ -204,8 +727,11 @@ def object_equals(a, b):
             return False
     return True
 
-def object_diff(a, b, policy=None):
+# pool: a multiprocessing.Pool to diff the changed keys in, see diff_many
+@fingerprinted
+def object_diff(a, b, policy=None, pool=None):
     c = {}
+    changed = []
 
     if policy and 'attributes' in policy:
         policy = policy['attributes']
@@ -217,19 +743,30 @@ def object_diff(a, b, policy=None):
             sub_policy = None
 
         if k in b:
-            if not equals(v, b[k]):
+            if equals(v, b[k]):
+                continue
+            if pool is None:
                 c[k] = diff(v, b[k], sub_policy)
+            else:
+                changed.append((k, (v, b[k], sub_policy)))
         else:
             c[k] = {'o':'-'}
     for k,v in b.iteritems():
         if k not in a:
             c[k] = {'o':'+', 'v':v}
 
+    if changed:
+        keys, pairs = zip(*changed)
+        c.update(zip(keys, diff_many(pairs, pool)))
+
     return c
 
-def apply_object_diff(a, c):
-    ac = copy.deepcopy(a)
+def apply_object_diff(a, c, mode='copy'):
+    ac, mode = apply_target(a, mode)
+    stats = current_differ().stats
     for k,o in c.iteritems():
+        if stats is not None:
+            started = op_started()
         if o['o'] == '-':
             del ac[k]
         elif o['o'] == '+':
@@ -239,18 +776,18 @@ def apply_object_diff(a, c):
         elif o['o'] == 'I':
             ac[k] += o['v']
         elif o['o'] == 'L':
-            ac[k] = apply_list_diff(a[k], o['v'])
+            ac[k] = apply_list_diff(ac[k], o['v'], mode)
         elif o['o'] == 'dL':
-            ac[k] = apply_list_diff_dmp(a[k], o['v'])
+            ac[k] = apply_list_diff_dmp(ac[k], o['v'])
         elif o['o'] == 'O':
-            ac[k] = apply_object_diff(a[k], o['v'])
+            ac[k] = apply_object_diff(ac[k], o['v'], mode)
         elif o['o'] == 'd':
-            diffs = DMP.diff_fromDelta(a[k], o['v'])
-            patches = DMP.patch_make(a[k], diffs)
-            result = DMP.patch_apply(patches, a[k])
-            ac[k] = result[0]
+            ac[k] = patch_text(ac[k], o['v'])
+        if stats is not None:
+            op_finished(stats, 'apply', o['o'], started)
     return ac
 
+@fingerprinted
 def transform_list_diff(ad, bd, s, policy=None):
     ac = {}
     b_inserts = []
@@ -264,13 +801,20 @@ def transform_list_diff(ad, bd, s, policy=None):
         index = int(index)
         if op['o'] == '+': b_inserts.append(index)
         if op['o'] == '-': b_deletes.append(index)
+    b_inserts.sort()
+    b_deletes.sort()
     last_index = 0
     last_shift = 0
 
-    for index, op in ad.iteritems():
-        index = int(index)
-        shift_r = len(filter(lambda x: x < index, b_inserts))
-        shift_l = len(filter(lambda x: x < index, b_deletes))
+    # walk ad in index order so the counts of b inserts/deletes in front of
+    # each op only ever move forward
+    shift_r = 0
+    shift_l = 0
+    for index, op in sorted(((int(i), o) for i, o in ad.iteritems()), key=lambda x: x[0]):
+        while shift_r < len(b_inserts) and b_inserts[shift_r] < index:
+            shift_r += 1
+        while shift_l < len(b_deletes) and b_deletes[shift_l] < index:
+            shift_l += 1
 
         if last_index+1 == index:
             index = index + last_shift
@@ -298,14 +842,18 @@ def transform_list_diff(ad, bd, s, policy=None):
 
 # diff a on S0 and diff b on S0
 # return a' where T(T(S0, b), a') == T(T(S0, a), b') # not really since DMP deltas will not satisfy this property
+@fingerprinted
 def transform_object_diff(a, b, s, policy=None):
     ac = copy.deepcopy(a)
 
     if policy and 'attributes' in policy:
         policy = policy['attributes']
 
+    stats = current_differ().stats
     for k, op in a.iteritems():
         if k in b:
+            if stats is not None:
+                started = op_started()
             if policy and k in policy:
                 sub_policy = policy[k]
             else:
@@ -334,10 +882,7 @@ def transform_object_diff(a, b, s, policy=None):
                 elif op['o'] == 'I':
                     ac[k]['v'] = sk + op['v']
                 elif op['o'] == 'd':
-                    diffs = DMP.diff_fromDelta(sk, op['v'])
-                    patches = DMP.patch_make(sk, diffs)
-                    result = DMP.patch_apply(patches, sk)
-                    ac[k]['v'] = result[0]
+                    ac[k]['v'] = patch_text(sk, op['v'])
             elif op['o'] == 'O' and b[k]['o'] == 'O':
                 ac[k] = {'o':'O', 'v':transform_object_diff(op['v'], b[k]['v'], sk, sub_policy)}
             elif op['o'] == 'L' and b[k]['o'] == 'L':
@@ -346,16 +891,18 @@ def transform_object_diff(a, b, s, policy=None):
                 ac[k] = {'o':'dL', 'v':transform_list_diff_dmp(op['v'], b[k]['v'], sk, sub_policy)}
             elif op['o'] == 'd' and b[k]['o'] == 'd':
                 del ac[k]
-                a_patches = DMP.patch_make(sk, DMP.diff_fromDelta(sk, op['v']))
-                b_patches = DMP.patch_make(sk, DMP.diff_fromDelta(sk, b[k]['v']))
-                b_text = DMP.patch_apply(b_patches, sk)[0]
-                ab_text = DMP.patch_apply(a_patches, b_text)[0]
-                diffs = DMP.diff_main(b_text, ab_text)
+                dmp = current_differ().dmp
+                a_patches = dmp.patch_make(sk, dmp.diff_fromDelta(sk, op['v']))
+                b_text = patch_text(sk, b[k]['v'])
+                ab_text = transform_patches(a_patches, b_text)
+                diffs = text_diffs(b_text, ab_text)
                 if len(diffs) > 2:
-                    DMP.diff_cleanupEfficiency(diffs)
+                    dmp.diff_cleanupEfficiency(diffs)
                 if len(diffs) > 0:
-                    delta = DMP.diff_toDelta(diffs)
+                    delta = dmp.diff_toDelta(diffs)
                     ac[k] = {'o':'d', 'v':delta}
+            if stats is not None:
+                op_finished(stats, 'transform', op['o'], started)
         else:
             # nothing to transform
             pass
@@ -367,9 +914,249 @@ def transform_object_diff(a, b, s, policy=None):
 def transform(a, diffs, s, policy=None):
     for diff in diffs:
         a = transform_object_diff(a, diff, s, policy)
-        s = apply_diff(s, diff)
+        s = apply_diff(s, diff, 'share')
     return a
 
+# d1 = diff on s, d2 = diff on apply_diff(s, d1)
+# return one diff on s with the same result as applying d1 then d2
+@fingerprinted
+def compose(d1, d2, s, policy=None):
+    dc = dict(d1)
+
+    if policy and 'attributes' in policy:
+        policy = policy['attributes']
+
+    for k, op in d2.iteritems():
+        if k not in d1:
+            dc[k] = op
+            continue
+
+        if policy and k in policy:
+            sub_policy = policy[k]
+        else:
+            sub_policy = None
+
+        first = d1[k]
+        if op['o'] == '-':
+            if first['o'] == '+':
+                del dc[k]
+            else:
+                dc[k] = op
+        elif op['o'] in ['+', 'r']:
+            if first['o'] == '+':
+                dc[k] = {'o':'+', 'v':op['v']}
+            else:
+                dc[k] = {'o':'r', 'v':op['v']}
+        elif first['o'] in ['+', 'r']:
+            dc[k] = {'o':first['o'], 'v':apply_object_diff({k:first['v']}, {k:op}, 'share')[k]}
+        elif first['o'] == 'I' and op['o'] == 'I':
+            dc[k] = {'o':'I', 'v':first['v'] + op['v']}
+        elif first['o'] == 'O' and op['o'] == 'O':
+            dc[k] = {'o':'O', 'v':compose(first['v'], op['v'], s[k], sub_policy)}
+        else:
+            v = None
+            if first['o'] == op['o'] and op['o'] in ['d', 'dL']:
+                v = dmp_patch.compose_deltas(first['v'], op['v'])
+            elif first['o'] == 'L' and op['o'] == 'L':
+                v = compose_list_diff(first['v'], op['v'], s[k], sub_policy)
+            if v is not None:
+                dc[k] = {'o':op['o'], 'v':v}
+            else:
+                sk = apply_object_diff({k:s[k]}, {k:first}, 'share')
+                sk = apply_object_diff(sk, {k:op}, 'share')[k]
+                dc[k] = diff(s[k], sk, sub_policy)
+                if not dc[k]:
+                    del dc[k]
+    return dc
+
+# list diff c as a sequence of ('=', count) runs of untouched items and
+# (op type, op) entries, n = length of the list c applies to
+def list_ops(c, n):
+    seq = []
+    prev = 0
+    for i, o in sorted(((int(i), o) for i, o in c.iteritems()), key=lambda x: x[0]):
+        if i > prev:
+            seq.append(('=', i - prev))
+            n -= i - prev
+        seq.append((o['o'], o))
+        if o['o'] != '+':
+            n -= 1
+        prev = i + 1
+    if n > 0:
+        seq.append(('=', n))
+    return seq
+
+# c1 = list diff on s, c2 = list diff on apply_list_diff(s, c1)
+# returns one list diff on s, or None if c2 doesn't fit the result of c1
+def compose_list_diff(c1, c2, s, policy=None):
+    if policy and 'item' in policy:
+        policy = {'attributes':{'0':policy['item']}}
+    else:
+        policy = None
+
+    n1 = len(s)
+    for o in c1.itervalues():
+        if o['o'] == '+':
+            n1 += 1
+        elif o['o'] == '-':
+            n1 -= 1
+    seq1 = list_ops(c1, len(s))
+    seq1.reverse()
+
+    # ops of the result, with counts of untouched items in between
+    seq = []
+    base = 0
+    for kind, o in list_ops(c2, n1):
+        if kind == '+':
+            seq.append(o)
+            continue
+        count = o if kind == '=' else 1
+        while count > 0:
+            if not seq1:
+                return None
+            kind1, o1 = seq1.pop()
+            if kind1 == '-':
+                seq.append(o1)
+                base += 1
+                continue
+            if kind1 == '=':
+                take = min(count, o1)
+                if take < o1:
+                    seq1.append(('=', o1 - take))
+                if kind == '=':
+                    seq.append(take)
+                else:
+                    seq.append(o)
+                base += take
+                count -= take
+                continue
+            if kind == '=':
+                seq.append(o1)
+            elif kind != '-':
+                sk = {}
+                if kind1 != '+':
+                    sk['0'] = s[base]
+                # both changed the item, 1 keeps it if they cancel out
+                oc = compose({'0':o1}, {'0':o}, sk, policy)
+                seq.append(oc.get('0', 1))
+            elif kind1 != '+':
+                seq.append(o)
+            if kind1 != '+':
+                base += 1
+            count -= 1
+    for kind1, o1 in seq1:
+        if kind1 != '-':
+            return None
+        seq.append(o1)
+
+    c = {}
+    i = 0
+    for e in seq:
+        if type(e) == dict:
+            c[str(i)] = e
+            i += 1
+        else:
+            i += e
+    return c
+
+# consecutive diffs composed as they are appended, the first one on s
+# diffs are merged pairwise like the digits of a binary counter, so each is
+# composed O(log n) times instead of into one ever growing diff
+class composition:
+    def __init__(self, s, policy=None):
+        self.policy = policy
+        self.count = 0
+        self.version = s
+        # [(number of diffs, version they apply to, composed diff)]
+        self.blocks = []
+
+    # version = result of d on the latest version, applied if not given
+    def append(self, d, version=None):
+        if version is None:
+            version = apply_diff(self.version, d, 'share')
+        self.blocks.append((1, self.version, d))
+        self.version = version
+        self.count += 1
+        while len(self.blocks) > 1 and self.blocks[-2][0] == self.blocks[-1][0]:
+            n2, s2, d2 = self.blocks.pop()
+            n1, s1, d1 = self.blocks.pop()
+            self.blocks.append((n1 + n2, s1, compose(d1, d2, s1, self.policy)))
+
+    def diff(self):
+        dc = {}
+        for n, s, d in reversed(self.blocks):
+            dc = compose(d, dc, s, self.policy)
+        return dc
+
+# diffs = list of consecutive operations, the first one on s
+def compose_many(diffs, s, policy=None):
+    c = composition(s, policy)
+    for d in diffs:
+        c.append(d)
+    return c.diff()
+
+# server side list of consecutive diffs starting at base, version 0
+# versions are kept with shared structure, composed ranges are cached so
+# clients catching up from the same version only compose new diffs
+class history:
+    def __init__(self, base, policy=None):
+        self.policy = policy
+        self.first = 0
+        self.versions = [base]
+        self.diffs = []
+        self.composed = {}
+
+    def latest(self):
+        return self.first + len(self.diffs)
+
+    def version(self, n):
+        if n < self.first or n > self.latest():
+            raise IndexError("no version %d" % n)
+        return self.versions[n - self.first]
+
+    def append(self, d):
+        self.diffs.append(d)
+        self.versions.append(apply_diff(self.versions[-1], d, 'share'))
+
+    # drops the versions before start, e.g. those older than any client's
+    def trim(self, start):
+        self.version(start)
+        del self.versions[:start - self.first]
+        del self.diffs[:start - self.first]
+        self.first = start
+        for k in self.composed.keys():
+            if k < start:
+                del self.composed[k]
+
+    def compose(self, start, end=None):
+        if end is None:
+            end = self.latest()
+        c = self.composed.get(start)
+        if c is None or start + c.count > end:
+            c = composition(self.version(start), self.policy)
+        for i in range(start + c.count, end):
+            c.append(self.diffs[i - self.first], self.version(i + 1))
+        self.composed[start] = c
+        return c.diff()
+
+    # a = operation on version start, returns it rebased onto the latest
+    # version, in one step over the composed diffs unless a text edit of a
+    # loses its context over the whole range, then version by version
+    def transform(self, a, start):
+        previous = getattr(SCOPE, 'strict', False)
+        SCOPE.strict = True
+        try:
+            return transform_object_diff(a, self.compose(start), self.version(start), self.policy)
+        except patch_conflict:
+            pass
+        finally:
+            SCOPE.strict = previous
+        for i in range(start, self.latest()):
+            a = transform_object_diff(a, self.diffs[i - self.first], self.version(i), self.policy)
+        return a
+
+@fingerprinted
+@recorded
 def diff(a, b, policy=None):
     if equals(a,b):
         return {}
@@ -388,11 +1175,12 @@ def diff(a, b, policy=None):
         elif otype == 'integer':
             return {'o': 'I', 'v': b-a}
         elif otype == 'string':
-            diffs = DMP.diff_main(a, b)
+            dmp = current_differ().dmp
+            diffs = text_diffs(a, b)
             if len(diffs) > 2:
-                DMP.diff_cleanupEfficiency(diffs)
+                dmp.diff_cleanupEfficiency(diffs)
             if len(diffs) > 0:
-                delta = DMP.diff_toDelta(diffs)
+                delta = dmp.diff_toDelta(diffs)
                 return {'o':'d', 'v':delta}
 
     if not same_type(a,b):
@@ -407,24 +1195,122 @@ def diff(a, b, policy=None):
     elif type(a) == dict:
         return {'o':'O', 'v': object_diff(a, b, policy)}
     elif isinstance(a, basestring):
-        diffs = DMP.diff_main(a, b)
+        dmp = current_differ().dmp
+        diffs = text_diffs(a, b)
         if len(diffs) > 2:
-            DMP.diff_cleanupEfficiency(diffs)
+            dmp.diff_cleanupEfficiency(diffs)
         if len(diffs) > 0:
-            delta = DMP.diff_toDelta(diffs)
+            delta = dmp.diff_toDelta(diffs)
             return {'o':'d', 'v':delta}
     return {}
 
+def diff_task(task):
+    d, deadline, a, b, policy = task
+    # a forked worker may have inherited the scope of the caller
+    SCOPE.fingerprints = None
+    SCOPE.compared = None
+    SCOPE.kept = None
+    SCOPE.differ = d
+    SCOPE.deadline = deadline
+    return diff(a, b, policy)
+
+# diff every (a, b, policy) of pairs in a process pool, with the settings of
+# the current differ; returns the diffs in the order of pairs, the same as
+# diffing them one by one
+# the pairs share what is left of the caller's budget, and the workers don't
+# record op stats
+# pool: a multiprocessing.Pool to use, by default one with processes workers
+#   is started for the call
+def diff_many(pairs, pool=None, processes=None):
+    d = current_differ()
+    deadline = getattr(SCOPE, 'deadline', None)
+    tasks = [(d, deadline, a, b, policy) for a, b, policy in pairs]
+    if pool is not None:
+        return pool.map(diff_task, tasks)
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(diff_task, tasks)
+    finally:
+        pool.terminate()
+        pool.join()
+
 # transform should work on CHANGES
 # CHANGE = {'o':TYPE, 'v':VALUE}
 # diffs should work on OPERATIONS?
 # DIFF = {'}
-def apply_diff(a, ops):
+def apply_diff(a, ops, mode='copy'):
     if type(a) == dict:
-        return apply_object_diff(a, ops)
+        return apply_object_diff(a, ops, mode)
     elif type(a) == list:
-        return apply_list_diff(a, ops)
+        return apply_list_diff(a, ops, mode)
 
+# diff engine with its own diff_match_patch settings, time budget and caches
+# the module functions run with the default differ unless called through one
+# timeout: seconds DMP may spend on each text diff
+# budget: seconds all text diffs of one call may spend together, or None
+# cache_size: items kept in the list_dmp line cache, 0 to disable it; cached
+#   items must not be modified in place
+# stats: op_stats or similar hook recording the time spent per op type
+# options: other diff_match_patch settings, e.g. Match_Threshold=0.3
 class differ:
-    def __init__(self):
-        pass
+    def __init__(self, policy=None, timeout=1.0, budget=None, cache_size=0, stats=None, **options):
+        self.policy = policy
+        self.timeout = timeout
+        self.budget = budget
+        self.cache_size = cache_size
+        self.stats = stats
+        self.options = options
+        self.dmp = dmp_patch.diff_match_patch_ucs2()
+        self.dmp.Diff_Timeout = timeout
+        for k, v in options.iteritems():
+            if not hasattr(self.dmp, k):
+                raise TypeError("Unknown diff_match_patch option: %s" % k)
+            setattr(self.dmp, k, v)
+        if cache_size:
+            self.lines = line_cache(cache_size)
+        else:
+            self.lines = None
+
+    # pickled for the workers of diff_many, without its cache and stats
+    def __getstate__(self):
+        return (self.policy, self.timeout, self.budget, self.cache_size, self.options)
+
+    def __setstate__(self, state):
+        policy, timeout, budget, cache_size, options = state
+        self.__init__(policy, timeout, budget, cache_size, None, **options)
+
+    # call f with this differ as the current one
+    def run(self, f, *args, **kwargs):
+        previous = (getattr(SCOPE, 'differ', None), getattr(SCOPE, 'deadline', None))
+        SCOPE.differ = self
+        if self.budget is not None:
+            SCOPE.deadline = time.time() + self.budget
+        else:
+            SCOPE.deadline = None
+        try:
+            return f(*args, **kwargs)
+        finally:
+            SCOPE.differ, SCOPE.deadline = previous
+
+    def diff(self, a, b, policy=None):
+        return self.run(diff, a, b, policy or self.policy)
+
+    def diff_many(self, pairs, pool=None, processes=None):
+        pairs = [(a, b, policy or self.policy) for a, b, policy in pairs]
+        return self.run(diff_many, pairs, pool, processes)
+
+    def apply_diff(self, a, ops, mode='copy'):
+        return self.run(apply_diff, a, ops, mode)
+
+    def transform_object_diff(self, a, b, s, policy=None):
+        return self.run(transform_object_diff, a, b, s, policy or self.policy)
+
+    def transform(self, a, diffs, s, policy=None):
+        return self.run(transform, a, diffs, s, policy or self.policy)
+
+    def compose(self, d1, d2, s, policy=None):
+        return self.run(compose, d1, d2, s, policy or self.policy)
+
+DEFAULT = differ()
+
+DMP = DEFAULT.dmp
@@ -0,0 +1,230 @@
+"""
+benchmark.py
+
+Throughput and peak memory of diff, apply_diff and transform over generated
+documents. Each case runs in its own process so peak memory isn't shared.
+
+    cd dist/python
+    python -m jsondiff.benchmark [-n repeat] [-s] [case ...]
+"""
+
+import sys
+import time
+import json
+import Queue
+import random
+import resource
+import optparse
+import multiprocessing
+
+import jsondiff
+
+def wide_object(n=5000, changed=50):
+    a = dict(('key%d' % i, {'id':i, 'name':'item %d' % i, 'on':True}) for i in range(n))
+    b = dict(a)
+    for i in range(0, n, n / changed):
+        b['key%d' % i] = {'id':i, 'name':'changed %d' % i, 'on':False}
+    return a, b, None
+
+def deep_object(depth=100):
+    def nest(leaf):
+        o = {'leaf':leaf, 'other':{'x':range(10)}}
+        for i in range(depth):
+            o = {'level':i, 'child':o, 'other':{'x':range(10)}}
+        return o
+    return nest('before'), nest('after'), None
+
+# a full tree with one leaf changed
+def tree(depth=8, width=4):
+    def grow(depth, leaf):
+        if depth == 0:
+            return {'v':leaf, 'n':[1, 2, 3]}
+        t = dict(('k%d' % i, grow(depth - 1, 'leaf')) for i in range(1, width))
+        t['k0'] = grow(depth - 1, leaf)
+        return t
+    return grow(depth, 'before'), grow(depth, 'after'), None
+
+def shifted_list(n=2000, shift=37, policy=None):
+    a = [{'id':i, 'text':'row %d' % i} for i in range(n)]
+    b = a[shift:] + a[:shift]
+    b[n / 2] = {'id':'changed'}
+    return {'l':a}, {'l':b}, {'attributes':{'l':policy}}
+
+# every item changed in place
+def changed_list(n=2000, policy=None):
+    a = [{'id':i, 'text':'row %d' % i} for i in range(n)]
+    b = [{'id':i, 'text':'row %d changed' % i} for i in range(n)]
+    return {'l':a}, {'l':b}, {'attributes':{'l':policy}}
+
+def edited_text(n, edits):
+    alphabet = u'abc def \U0001F47F\U0001F600\U0001F607\xe9'
+    text = u''.join(random.choice(alphabet) for i in range(n))
+    edited = list(text)
+    for i in range(edits):
+        p = random.randrange(len(edited))
+        # keep surrogate pairs in one piece
+        while p and 0xDC00 <= ord(edited[p]) <= 0xDFFF:
+            p -= 1
+        edited.insert(p, random.choice(u'xyz\U0001F607'))
+    return text, u''.join(edited)
+
+def long_text(n=50000, edits=20):
+    random.seed(1)
+    a, b = edited_text(n, edits)
+    return {'s':a}, {'s':b}, None
+
+def text_fields(fields=8, n=20000, edits=20):
+    random.seed(3)
+    a, b = {}, {}
+    for i in range(fields):
+        a['field%d' % i], b['field%d' % i] = edited_text(n, edits)
+    return a, b, None
+
+# stored documents and their changed copies, as in a reconciliation pass
+def documents(n=200):
+    random.seed(4)
+    docs = []
+    for i in range(n):
+        a, b = edited_text(2000, 5)
+        docs.append(({'id':i, 'body':a, 'tags':['x']}, {'id':i, 'body':b, 'tags':['x', 'y']}, None))
+    return docs
+
+def history(versions=500):
+    random.seed(2)
+    policy = {'attributes':{'n':{'otype':'integer'}, 'l':{'otype':'list'}}}
+    s = {'title':'note', 'body':'text ' * 200, 'n':0, 'l':range(20)}
+    diffs = []
+    v = s
+    for i in range(versions):
+        nv = dict(v)
+        nv['n'] = v['n'] + 1
+        k = random.choice(['body', 'title', 'l'])
+        if k == 'l':
+            nv['l'] = v['l'][1:] + [i]
+        else:
+            p = random.randrange(len(v[k]) + 1)
+            nv[k] = v[k][:p] + 'v%d' % i + v[k][p:]
+        diffs.append(jsondiff.diff(v, nv, policy)['v'])
+        v = nv
+    client = jsondiff.diff(s, dict(s, title='client title'), policy)['v']
+    return s, diffs, client, policy
+
+CORPORA = {
+    'wide_object': wide_object,
+    'deep_object': deep_object,
+    'tree': tree,
+    'shifted_list': lambda: shifted_list(policy={'otype':'list'}),
+    'shifted_list_lcs': lambda: shifted_list(policy={'otype':'list', 'algorithm':'lcs'}),
+    'shifted_list_dmp': lambda: shifted_list(policy={'otype':'list_dmp'}),
+    'changed_list_lcs': lambda: changed_list(policy={'otype':'list', 'algorithm':'lcs'}),
+    'changed_list_dmp': lambda: changed_list(policy={'otype':'list_dmp'}),
+    'long_text': long_text,
+    'text_fields': text_fields,
+}
+
+def cases():
+    for name in sorted(CORPORA):
+        make = CORPORA[name]
+        yield name + '.diff', lambda make=make: diff_case(make)
+        yield name + '.apply', lambda make=make: apply_case(make)
+        yield name + '.apply_share', lambda make=make: apply_case(make, 'share')
+    yield 'text_fields.diff_pool', pool_diff_case
+    yield 'documents.diff', lambda: documents_case(False)
+    yield 'documents.diff_many', lambda: documents_case(True)
+    yield 'history.transform', transform_case
+    yield 'history.catch_up', catch_up_case
+
+# each case returns (run, size in bytes of the json processed per run)
+def diff_case(make):
+    a, b, policy = make()
+    size = len(json.dumps(a)) + len(json.dumps(b))
+    return lambda: jsondiff.diff(a, b, policy), size
+
+def apply_case(make, mode='copy'):
+    a, b, policy = make()
+    ops = jsondiff.diff(a, b, policy)['v']
+    return lambda: jsondiff.apply_diff(a, ops, mode), len(json.dumps(a))
+
+# the pools are started before measuring, as a long running job would
+def pool_diff_case():
+    a, b, policy = text_fields()
+    pool = multiprocessing.Pool()
+    return lambda: jsondiff.object_diff(a, b, policy, pool), len(json.dumps(a)) + len(json.dumps(b))
+
+def documents_case(parallel):
+    docs = documents()
+    size = sum(len(json.dumps(a)) + len(json.dumps(b)) for a, b, policy in docs)
+    if parallel:
+        pool = multiprocessing.Pool()
+        return lambda: jsondiff.diff_many(docs, pool), size
+    return lambda: [jsondiff.diff(a, b, policy) for a, b, policy in docs], size
+
+def transform_case():
+    s, diffs, client, policy = history()
+    size = len(json.dumps(diffs))
+    return lambda: jsondiff.transform(client, diffs, s, policy), size
+
+# a client on the first version catching up through history.transform, the
+# cached compositions are dropped so each run composes all of the diffs
+def catch_up_case():
+    s, diffs, client, policy = history()
+    h = jsondiff.history(s, policy)
+    for d in diffs:
+        h.append(d)
+    def run():
+        h.composed.clear()
+        return h.transform(client, 0)
+    return run, len(json.dumps(diffs))
+
+def measure(make, repeat, stats, queue):
+    run, size = make()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    d = None
+    if stats:
+        d = jsondiff.differ(stats=jsondiff.op_stats())
+        run = lambda run=run: d.run(run)
+    start = time.time()
+    for i in range(repeat):
+        run()
+    seconds = (time.time() - start) / repeat
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    queue.put((seconds, size, peak, d and d.stats.report()))
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [-n repeat] [-s] [case ...]')
+    parser.add_option('-n', '--repeat', type='int', default=5)
+    parser.add_option('-s', '--stats', action='store_true', help='print time per op type')
+    options, names = parser.parse_args(argv)
+
+    print '%-32s %12s %10s %10s %12s' % ('case', 'ms/op', 'ops/s', 'MB/s', 'peak KB')
+    for name, make in cases():
+        if names and not [n for n in names if name.startswith(n)]:
+            continue
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=measure, args=(make, options.repeat, options.stats, queue))
+        p.start()
+        result = None
+        while result is None:
+            try:
+                result = queue.get(timeout=1)
+            except Queue.Empty:
+                if not p.is_alive():
+                    break
+        p.join()
+        if result is None:
+            # the child may have put its result just before exiting
+            try:
+                result = queue.get_nowait()
+            except Queue.Empty:
+                pass
+        if p.exitcode or result is None:
+            print '%-32s failed' % name
+            continue
+        seconds, size, peak, report = result
+        print '%-32s %12.3f %10.1f %10.2f %12d' % (
+            name, seconds * 1000, 1 / seconds, size / seconds / 1e6, peak)
+        for phase, otype, calls, total in report or []:
+            print '    %-10s %-3s %8d calls %10.3f ms' % (phase, otype, calls, total * 1000)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
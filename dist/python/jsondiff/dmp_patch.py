@@ -1,10 +1,21 @@
+import re
 import urllib
 
+from bisect import bisect_left
 from diffmatchpatch import diff_match_patch
 
+if 1 == len( u'\U0001f4a9' ):
+    ASTRAL = re.compile( u'[\U00010000-\U0010ffff]' )
+else:
+    ASTRAL = None
+
 def length_ucs2( string ):
     return len( string.encode( 'UTF-16LE' ) ) / 2
 
+def delta_insert( data ):
+    # High ascii will raise UnicodeDecodeError.  Use Unicode instead.
+    return "+" + urllib.quote( data.encode( "utf-8" ), "!~*'();/?:@&=+$,# " )
+
 def diff_toDelta_ucs2(self, diffs):
     """Crush the diff into an encoded string which describes the operations
     required to transform text1 into text2.
@@ -20,9 +31,7 @@ def diff_toDelta_ucs2(self, diffs):
     text = []
     for (op, data) in diffs:
         if op == self.DIFF_INSERT:
-            # High ascii will raise UnicodeDecodeError.  Use Unicode instead.
-            data = data.encode("utf-8")
-            text.append("+" + urllib.quote(data, "!~*'();/?:@&=+$,# "))
+            text.append(delta_insert(data))
         elif op == self.DIFF_DELETE:
             text.append("-%d" % length_ucs2(data))
         elif op == self.DIFF_EQUAL:
@@ -91,6 +100,164 @@ def diff_fromDelta_ucs2(self, text1, delta):
             (pointer_ucs2, length_ucs2(text1)))
     return diffs
 
+def apply_delta( text, delta ):
+    """Apply a delta to the exact text it was made from by slicing, without
+    building and fuzzy matching patches. Offsets are in UCS-2 code units, as
+    in diff_fromDelta_ucs2.
+
+    Args:
+      text: Source string the delta was made from.
+      delta: Delta text.
+
+    Returns:
+      The patched string, or None if the delta does not fit text exactly.
+    """
+    if type( delta ) == unicode:
+        try:
+            delta = delta.encode( "ascii" )
+        except UnicodeEncodeError:
+            return None
+
+    # UCS-2 offsets of the characters outside the BMP, which count twice
+    units = []
+    if ASTRAL is not None:
+        units = [ m.start() + i for i, m in enumerate( ASTRAL.finditer( text ) ) ]
+
+    def char_offset( unit ):
+        k = bisect_left( units, unit )
+        if k and units[k - 1] + 1 == unit:
+            # would split a surrogate pair
+            return None
+        return unit - k
+
+    result = []
+    pointer = 0
+    pointer_ucs2 = 0
+    for token in delta.split( "\t" ):
+        if token == "":
+            continue
+        param = token[1:]
+        if token[0] == "+":
+            try:
+                result.append( urllib.unquote( param ).decode( "utf-8" ) )
+            except UnicodeDecodeError:
+                return None
+        elif token[0] == "-" or token[0] == "=":
+            try:
+                n_ucs2 = int( param )
+            except ValueError:
+                return None
+            if n_ucs2 < 0:
+                return None
+            pointer_ucs2 += n_ucs2
+            end = char_offset( pointer_ucs2 )
+            if end is None or end > len( text ):
+                return None
+            if token[0] == "=":
+                result.append( text[pointer : end] )
+            pointer = end
+        else:
+            return None
+    if pointer != len( text ):
+        return None
+    return "".join( result )
+
+def parse_delta( delta ):
+    """Split a delta into ( op, value ) tuples, value being the number of
+    UCS-2 code units for "=" and "-", and the UTF-16LE encoded text for "+".
+    Returns None if the delta is invalid.
+    """
+    if type( delta ) == unicode:
+        try:
+            delta = delta.encode( "ascii" )
+        except UnicodeEncodeError:
+            return None
+    ops = []
+    for token in delta.split( "\t" ):
+        if token == "":
+            continue
+        param = token[1:]
+        if token[0] == "+":
+            try:
+                ops.append( ( "+", urllib.unquote( param ).decode( "utf-8" ).encode( "UTF-16LE" ) ) )
+            except UnicodeDecodeError:
+                return None
+        elif token[0] == "-" or token[0] == "=":
+            if not param.isdigit():
+                return None
+            ops.append( ( token[0], int( param ) ) )
+        else:
+            return None
+    return ops
+
+def compose_deltas( delta1, delta2 ):
+    """Merge two consecutive deltas into one, without their texts.
+
+    Args:
+      delta1: Delta from text1 to text2.
+      delta2: Delta from text2 to text3.
+
+    Returns:
+      Delta from text1 to text3, or None if delta2 does not fit the output
+      of delta1 or would split a surrogate pair.
+    """
+    ops1 = parse_delta( delta1 )
+    ops2 = parse_delta( delta2 )
+    if ops1 is None or ops2 is None:
+        return None
+    ops1.reverse()
+
+    result = []
+    def add( op, value ):
+        if result and result[-1][0] == op:
+            result[-1][1] += value
+        else:
+            result.append( [ op, value ] )
+
+    for op, value in ops2:
+        if op == "+":
+            add( "+", value )
+            continue
+        # consume value code units of the text delta1 produces
+        n = value
+        while n > 0:
+            if not ops1:
+                return None
+            op1, value1 = ops1.pop()
+            if op1 == "-":
+                add( "-", value1 )
+                continue
+            if op1 == "=":
+                take = min( n, value1 )
+                rest = value1 - take
+                if op == "=":
+                    add( "=", take )
+                else:
+                    add( "-", take )
+            else:
+                take = min( n, len( value1 ) / 2 )
+                rest = value1[take * 2:]
+                if op == "=":
+                    add( "+", value1[:take * 2] )
+            if rest:
+                ops1.append( ( op1, rest ) )
+            n -= take
+    for op1, value1 in reversed( ops1 ):
+        if op1 != "-":
+            return None
+        add( "-", value1 )
+
+    text = []
+    for op, value in result:
+        if op == "+":
+            try:
+                text.append( delta_insert( value.decode( "UTF-16LE" ) ) )
+            except UnicodeDecodeError:
+                return None
+        else:
+            text.append( "%s%d" % ( op, value ) )
+    return "\t".join( text )
+
 def is_leading_surrogate( char ):
     return 0xD800 <= ord( char ) <= 0xDBFF
 
@@ -260,6 +427,21 @@ def diff_commonOverlap(self, text1, text2):
             best = length
             length += 1
 
+class diff_match_patch_ucs2( diff_match_patch ):
+    """diff_match_patch with the fixes above, counting in UCS-2 code units
+    and never splitting surrogate pairs, without patching diff_match_patch
+    itself.
+    """
+    if 1 == len( u'\U0001f4a9' ):
+        diff_toDelta = diff_toDelta_ucs2
+        diff_fromDelta = diff_fromDelta_ucs2
+    diff_commonPrefix = diff_commonPrefix
+    diff_commonSuffix = diff_commonSuffix
+    diff_halfMatch = diff_halfMatch
+    diff_bisect = diff_bisect
+    diff_bisectSplit = diff_bisectSplit
+    diff_commonOverlap = diff_commonOverlap
+
 def monkey():
     if 1 == len( u'\U0001f4a9' ):
         diff_match_patch.diff_toDelta = diff_toDelta_ucs2
@@ -1,3 +1,5 @@
+import copy
+import random
 import unittest
 
 from jsondiff import *
@@ -220,6 +222,16 @@ class DifferTests(unittest.TestCase):
         self.assertEqual(object_diff(a, b), expect)
         self.assertTrue(object_equals(b, apply_object_diff(a, object_diff(a, b))))
 
+    def test_apply_delta(self):
+        self.assertEqual(dmp_patch.apply_delta(u"abc", "=1\t-1\t+x%20y\t=1"), u"ax yc")
+        self.assertEqual(dmp_patch.apply_delta(u"\U0001F47F#", "=2\t-1\t+%F0%9F%98%87"), u"\U0001F47F\U0001F607")
+        self.assertEqual(dmp_patch.apply_delta(u"\ud83d\udc7f#", "=3\t+!"), u"\ud83d\udc7f#!")
+        # doesn't fit the base text
+        self.assertEqual(dmp_patch.apply_delta(u"abc", "=2"), None)
+        self.assertEqual(dmp_patch.apply_delta(u"abc", "=4"), None)
+        self.assertEqual(dmp_patch.apply_delta(u"\U0001F47F", "=1\t-1"), None)
+        self.assertRaises(ValueError, patch_text, u"abc", "=4")
+
     def test_prefix(self):
         a = ['a', 'b', 'c']
         b = ['a', 'b', 'c', 'd']
@@ -259,6 +271,36 @@ class DifferTests(unittest.TestCase):
         b[0] = 1
         self.assertFalse(list_equals(a, b))
 
+    def test_fingerprint(self):
+        a = {'a':[1, 2, {'b':'c'}], 'd':True, 'e':1.5}
+        b = {'e':1.5, 'd':1, 'a':[True, 2, {'b':u'c'}]}
+        self.assertEqual(fingerprint(a), fingerprint(b))
+        self.assertNotEqual(fingerprint([1]), fingerprint([1.0]))
+        self.assertNotEqual(fingerprint({'a':[1, 2]}), fingerprint({'a':[2, 1]}))
+
+        equals_in_scope = fingerprinted(equals)
+        self.assertTrue(equals_in_scope(a, b))
+        b['a'][2]['b'] = 'x'
+        self.assertFalse(equals_in_scope(a, b))
+        self.assertTrue(equals_in_scope([True, {'a':1}], [1, {'a':True}]))
+
+        # compared containers stay alive, so a later one can't take an id
+        # that is remembered as equal
+        def compare_temporaries():
+            c = {'v':1}
+            d = {'v':1}
+            equals({'v':1}, c)
+            equals(c, d)
+            return [equals({'v':2}, c) for i in range(10)]
+        self.assertEqual(fingerprinted(compare_temporaries)(), [False] * 10)
+
+        # fingerprints already taken settle a mismatch
+        def compare_fingerprinted(a, b):
+            fingerprint(a)
+            fingerprint(b)
+            return equals(a, b)
+        self.assertFalse(fingerprinted(compare_fingerprinted)({'a':[1]}, {'a':[2]}))
+
     def test_list_diff(self):
         a = ['a', 'b', 'c', 'd', 'e']
         b = ['a', 'b', 'c', 'd']
@@ -288,6 +330,126 @@ class DifferTests(unittest.TestCase):
         b = ['a', 'b', 'c']
         self.assertEqual(apply_list_diff(a, list_diff(a, b)), b)
 
+    def test_list_diff_lcs(self):
+        policy = {'otype':'list', 'algorithm':'lcs'}
+
+        a = ['a', 'b', 'c', 'd', 'e']
+        b = ['b', 'c', 'd', 'e', 'a']
+        self.assertEqual(list_diff(a, b, policy), {'0':{'o':'-'}, '5':{'o':'+', 'v':'a'}})
+        self.assertEqual(apply_list_diff(a, list_diff(a, b, policy)), b)
+
+        a = ['a', 'b', 'x', 'q', 'd', 'e']
+        b = ['a', 'b', 'c']
+        self.assertEqual(apply_list_diff(a, list_diff(a, b, policy)), b)
+
+        a = [{'id':1, 'n':1}, {'id':2}, 3]
+        b = [{'id':2}, {'id':1, 'n':2}, True]
+        self.assertEqual(apply_list_diff(a, list_diff(a, b, policy)), b)
+
+        a = [{'id':i} for i in range(100)]
+        b = a[10:] + [{'id':'x'}] + a[:10]
+        b[50] = {'id':'y'}
+        self.assertEqual(apply_list_diff(a, list_diff(a, b, policy)), b)
+
+        a = [1, 2, 3]
+        self.assertEqual(list_diff(a, list(a), policy), {})
+        self.assertEqual(list_diff(a, [True, 2, 3], policy), {})
+
+        # equal hashes, hash(-1) == hash(-2) and hash('') == hash(0)
+        self.assertEqual(list_diff([-1], [-2], policy), {'0':{'o':'r', 'v':-2}})
+        self.assertEqual(list_diff([''], [0], policy), {'0':{'o':'r', 'v':0}})
+        self.assertEqual(apply_list_diff([1, -1, ''], list_diff([1, -1, ''], [-2, 0, 1], policy)), [-2, 0, 1])
+
+        # too many edits apart to search, only the ends are matched
+        self.assertEqual(lcs_matches([1, 2, 3, 4], [1, 3, 4, 2]), [(0, 0), (2, 1), (3, 2)])
+        self.assertEqual(lcs_matches([0, 1, 2, 3, 4, 9], [0, 3, 4, 2, 1, 9], 2), [(0, 0), (5, 5)])
+        a = [{'id':i} for i in range(5000)]
+        b = list(reversed(a))
+        self.assertEqual(apply_list_diff(a, list_diff(a, b, policy)), b)
+        # odd length, the middle item lines up with itself
+        a = range(2001)
+        b = list(reversed(a))
+        c = list_diff(a, b, policy)
+        self.assertFalse('1000' in c)
+        self.assertEqual(apply_list_diff(a, c), b)
+        self.assertEqual(apply_diff({'l':a}, diff({'l':a}, {'l':b}, {'attributes':{'l':policy}})['v']), {'l':b})
+
+    def test_apply_list_diff_many_ops(self):
+        a = range(30)
+        c = dict((str(i), {'o':'-'}) for i in range(0, 30, 3))
+        c['11'] = {'o':'r', 'v':'x'}
+        c['25'] = {'o':'I', 'v':100}
+        c['30'] = {'o':'+', 'v':'end'}
+        b = [e for e in a if e % 3]
+        b[b.index(11)] = 'x'
+        b[b.index(25)] = 125
+        b.append('end')
+        self.assertEqual(apply_list_diff(a, c), b)
+        self.assertRaises(IndexError, apply_list_diff, [1], {'0':{'o':'-'}, '1':{'o':'-'}})
+
+    def test_list_diff_dmp(self):
+        a = [{'id':1}, {'id':2, 's':'abc'}, 3, u'\U0001F47F']
+        b = [{'id':1}, {'id':2, 's':'abd'}, 'x', 3, u'\U0001F47F']
+        cache = line_cache()
+        d = list_diff_dmp(a, b, None, cache)
+        c = apply_list_diff_dmp(a, d, cache)
+        self.assertEqual(c, b)
+        self.assertTrue(c[0] is a[0])
+        self.assertFalse(c[1] is a[1])
+
+        # every item changed, each is rediffed on its own
+        a = [{'id':i} for i in range(2000)]
+        b = [{'id':-i} for i in range(2000)]
+        d = list_diff_dmp(a, b)
+        self.assertEqual(apply_list_diff_dmp(a, d), b)
+        self.assertFalse('\t-' in d)
+
+        # a delta that splits lines
+        lines = serialize_lines(a)
+        self.assertEqual(apply_lines_delta(a, lines, "=6\t-1\t+3\t=" + str(len(''.join(lines)) - 7)),
+            [{'id':3}] + a[1:])
+        # doesn't fit the lines
+        self.assertEqual(apply_lines_delta(a, lines, "=3"), None)
+        self.assertRaises(ValueError, apply_list_diff_dmp, a, "=3")
+
+        self.assertEqual(text_to_lines('1\n2\n'), ['1\n', '2\n'])
+        self.assertEqual(text_to_lines('1\n2'), ['1\n', '2'])
+        self.assertEqual(text_to_lines(''), [])
+
+    def test_transform_list_diff_dmp(self):
+        # the client's by character edit of 1 is patched into the empty text
+        # as ][ by the whole text patches, then redone by line
+        s = [1]
+        ad = list_diff_dmp(s, [[1]])
+        bd = list_diff_dmp(s, [])
+        self.assertEqual(ad, '+%5B\t=1\t+%5D\t=1')
+        td = transform_list_diff_dmp(ad, bd, s)
+        self.assertEqual(td, '+%5B1%5D%0A')
+        self.assertEqual(apply_list_diff_dmp([], td), [[1]])
+
+        # concurrent edits of both sides, the result of transform applies
+        random.seed(3)
+        values = [1, 2, 'x', u'\xe9', u'\U0001F47F', None, True, [1], {'a':1}, {'id':7, 's':'abcdef'}]
+        def edit(a):
+            b = list(a)
+            for i in range(random.randint(0, 4)):
+                r = random.random()
+                if r < 0.3 and b:
+                    b.pop(random.randrange(len(b)))
+                elif r < 0.6:
+                    b.insert(random.randint(0, len(b)), random.choice(values))
+                elif b:
+                    b[random.randrange(len(b))] = random.choice(values)
+            return b
+        for i in range(500):
+            s = [random.choice(values) for j in range(random.randint(0, 12))]
+            a = edit(s)
+            b = edit(s)
+            td = transform_list_diff_dmp(list_diff_dmp(s, a), list_diff_dmp(s, b), s)
+            result = apply_list_diff_dmp(b, td) if td else b
+            if serialize_lines(b) == serialize_lines(s):
+                self.assertEqual(serialize_lines(result), serialize_lines(a))
+
     def test_object_diffs(self):
         a = {'test':['a', 'b', 'c'], 'blah':{'hi':'test'}, 'num':50}
         b = {'test':['a', 'b'], 'blah':{'hi':'there'}, 'num':51}
@@ -301,6 +463,234 @@ class DifferTests(unittest.TestCase):
         b = {'blah':{'hi':'there'}, 'num':-10, 'new':{'list':['a', 'b', 'c']}}
         self.assertTrue(object_equals(b, apply_object_diff(a, object_diff(a, b))))
 
+    def test_apply_modes(self):
+        a = {'big':{'x':[1, 2, 3]}, 'n':{'m':{'s':'abc'}, 'l':[{'q':1}, 2]}}
+        b = {'big':{'x':[1, 2, 3]}, 'n':{'m':{'s':'abd'}, 'l':[{'q':2}, 2]}}
+        d = object_diff(a, b, {'attributes':{'n':{'attributes':{'l':{'otype':'list'}}}}})
+        a_before = copy.deepcopy(a)
+
+        c = apply_object_diff(a, d)
+        self.assertEqual(c, b)
+        self.assertEqual(a, a_before)
+        self.assertFalse(c['big'] is a['big'])
+
+        c = apply_object_diff(a, d, 'share')
+        self.assertEqual(c, b)
+        self.assertEqual(a, a_before)
+        self.assertTrue(c['big'] is a['big'])
+        self.assertFalse(c['n'] is a['n'])
+        self.assertFalse(c['n']['l'] is a['n']['l'])
+        self.assertTrue(c['n']['l'][1] is a['n']['l'][1])
+
+        c = apply_diff(a, d, 'inplace')
+        self.assertTrue(c is a)
+        self.assertEqual(a, b)
+
+        self.assertRaises(ValueError, apply_diff, a, d, 'bogus')
+
+        shared = {'v':1}
+        a = {'x':shared, 'y':shared}
+        c = apply_diff(a, diff(a, {'x':{'v':2}, 'y':{'v':1}})['v'])
+        self.assertEqual(c, {'x':{'v':2}, 'y':{'v':1}})
+
+    def test_compose(self):
+        policy = {'attributes':{'n':{'otype':'integer'}}}
+        s = {'s':'hello', 'n':1, 'o':{'a':1}, 'gone':1}
+        s1 = {'s':'hello world', 'n':3, 'o':{'a':2}, 'new':[1]}
+        s2 = {'s':'hello there world', 'n':2, 'o':{'a':2, 'b':1}}
+        d1 = diff(s, s1, policy)['v']
+        d2 = diff(s1, s2, policy)['v']
+        dc = compose(d1, d2, s, policy)
+        self.assertEqual(dc['n'], {'o':'I', 'v':1})
+        self.assertEqual(dc['gone'], {'o':'-'})
+        self.assertFalse('new' in dc)
+        self.assertEqual(apply_diff(s, dc), s2)
+        self.assertEqual(apply_diff(s, compose_many([d1, d2], s, policy)), s2)
+
+        # deltas and list diffs are composed without diffing again
+        self.assertEqual(dmp_patch.compose_deltas("=2\t+x\t=1", "-1\t=2\t+y\t=1"), "-1\t=1\t+xy\t=1")
+        self.assertEqual(dmp_patch.compose_deltas("=2", "=3"), None)
+        policy = {'otype':'list', 'algorithm':'lcs'}
+        a = [1, {'a':1}, 3]
+        b = [0, 1, {'a':2}, 3]
+        c = [0, {'a':3}, 3, 4]
+        cc = compose_list_diff(list_diff(a, b, policy), list_diff(b, c, policy), a, policy)
+        self.assertEqual(cc, {'0':{'o':'+', 'v':0}, '1':{'o':'r', 'v':{'a':3}}, '2':{'o':'-'}, '4':{'o':'+', 'v':4}})
+        self.assertEqual(apply_list_diff(a, cc), c)
+
+    def test_history(self):
+        versions = [{'a':'x', 'n':0}]
+        h = history(versions[0])
+        for i in range(1, 6):
+            v = dict(versions[-1])
+            v['n'] = i
+            v['a'] = v['a'] + str(i)
+            h.append(diff(versions[-1], v)['v'])
+            versions.append(v)
+        self.assertEqual(apply_diff(versions[1], h.compose(1)), versions[5])
+        self.assertEqual(apply_diff(versions[1], h.compose(1, 3)), versions[3])
+
+        a = {'c':{'o':'+', 'v':'client'}}
+        expected = dict(versions[5], c='client')
+        self.assertEqual(apply_diff(versions[5], h.transform(a, 2)), expected)
+        self.assertEqual(apply_diff(versions[5], transform(a, h.diffs[2:], versions[2])), expected)
+
+        # composed in pieces, the range from 1 to 3 is extended rather than redone
+        self.assertEqual(h.composed[1].count, 2)
+        self.assertEqual(apply_diff(versions[1], h.compose(1)), versions[5])
+        self.assertEqual(h.composed[1].count, 4)
+        self.assertEqual([b[0] for b in h.composed[1].blocks], [4])
+        c = composition(versions[0])
+        for d in h.diffs:
+            c.append(d)
+        self.assertEqual([b[0] for b in c.blocks], [4, 1])
+        self.assertEqual(apply_diff(versions[0], c.diff()), versions[5])
+
+        # the appended Z loses all of its context over the four diffs at
+        # once, so history.transform falls back to going version by version
+        s = {'s':u'\U0001F47Fx'}
+        diffs = [{'s':{'o':'d', 'v':'=2\t-1'}}, {'s':{'o':'d', 'v':'=2\t+ab'}},
+                 {'s':{'o':'d', 'v':'+Z\t=4'}}, {'s':{'o':'d', 'v':'=5\t+ab'}}]
+        latest = reduce(apply_diff, diffs, s)
+        self.assertEqual(latest, {'s':u'Z\U0001F47Fabab'})
+        a = {'s':{'o':'d', 'v':'=3\t+Z'}}
+        self.assertEqual(apply_diff(latest, transform(a, diffs, s)), {'s':u'Z\U0001F47FababZ'})
+        h = history(s)
+        for d in diffs:
+            h.append(d)
+        self.assertEqual(apply_diff(latest, h.transform(a, 0)), {'s':u'Z\U0001F47FababZ'})
+        SCOPE.strict = True
+        try:
+            self.assertRaises(patch_conflict, transform_object_diff, a, h.compose(0), s)
+        finally:
+            SCOPE.strict = False
+
+        # trimmed versions are gone, the later ones keep their numbers
+        h.trim(2)
+        self.assertEqual((h.first, h.latest(), len(h.versions)), (2, 4, 3))
+        self.assertEqual(h.composed.keys(), [])
+        self.assertRaises(IndexError, h.compose, 1)
+        self.assertEqual(apply_diff(h.version(2), h.compose(2)), latest)
+        a = {'s':{'o':'d', 'v':'=2\t+Y\t=2'}}
+        self.assertEqual(apply_diff(latest, h.transform(a, 2)), apply_diff(latest, transform(a, diffs[2:], h.version(2))))
+
+    def test_differ(self):
+        from diffmatchpatch import diff_match_patch
+        self.assertFalse(diff_match_patch.diff_bisect is dmp_patch.diff_match_patch_ucs2.diff_bisect)
+
+        policy = {'attributes':{'l':{'otype':'list_dmp'}, 'n':{'otype':'integer'}}}
+        d = differ(policy, timeout=0.5, budget=2.0, cache_size=100, Match_Threshold=0.3)
+        self.assertEqual(d.dmp.Diff_Timeout, 0.5)
+        self.assertEqual(d.dmp.Match_Threshold, 0.3)
+        self.assertNotEqual(DMP.Match_Threshold, 0.3)
+        self.assertRaises(TypeError, differ, Bogus=1)
+
+        a = {'s':u'\U0001F47F', 'l':[1, {'x':2}], 'n':1}
+        b = {'s':u'\U0001F47F#', 'l':[1, {'x':3}], 'n':2}
+        ops = d.diff(a, b)
+        self.assertEqual(ops['v']['s'], {'o':'d', 'v':'=2\t+#'})
+        self.assertEqual(ops['v']['n'], {'o':'I', 'v':1})
+        self.assertEqual(ops['v']['l']['o'], 'dL')
+        self.assertEqual(d.apply_diff(a, ops['v']), b)
+        self.assertTrue(len(d.lines.lines) > 0)
+
+        # the timeout still bounds each text diff when there is a budget
+        import random
+        import time
+        random.seed(1)
+        x = ''.join(random.choice('abcd') for i in range(10000))
+        y = ''.join(random.choice('abcd') for i in range(10000))
+        started = time.time()
+        differ(timeout=0.01, budget=60).run(text_diffs, x, y)
+        self.assertTrue(time.time() - started < 5)
+
+        # differs used from several threads at once
+        import threading
+        results = []
+        def work(n):
+            e = differ(timeout=0.1 * n)
+            for i in range(20):
+                v = {'s':'x' * i, 'n':n}
+                results.append(e.apply_diff(a, e.diff(a, v)['v']) == v)
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(1, 5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [True] * 80)
+
+    def test_diff_many(self):
+        import pickle
+        import multiprocessing
+        policy = {'attributes':{'l':{'otype':'list'}, 'n':{'otype':'integer'}}}
+        docs = []
+        for i in range(20):
+            a = {'s':'text %d ' % i * 20, 'l':range(i), 'n':i, 'o':{'x':i}, 'gone':1}
+            b = {'s':'txt %d ' % i * 20, 'l':range(1, i + 2), 'n':2 * i, 'o':{'x':-i}, 'new':i}
+            docs.append((a, b, policy))
+        serial = [diff(a, b, p) for a, b, p in docs]
+
+        pool = multiprocessing.Pool(2)
+        try:
+            self.assertEqual(diff_many(docs, pool), serial)
+            for a, b, p in docs:
+                self.assertEqual(object_diff(a, b, p, pool), object_diff(a, b, p))
+        finally:
+            pool.terminate()
+            pool.join()
+        self.assertEqual(diff_many(docs, processes=2), serial)
+        self.assertEqual(diff_many([]), [])
+
+        d = differ(policy, timeout=0.5, cache_size=10, stats=op_stats(), Match_Threshold=0.3)
+        e = pickle.loads(pickle.dumps(d))
+        self.assertEqual(e.dmp.Diff_Timeout, 0.5)
+        self.assertEqual(e.dmp.Match_Threshold, 0.3)
+        self.assertEqual(e.stats, None)
+        self.assertEqual(d.diff_many([(a, b, None) for a, b, p in docs], processes=2), serial)
+
+        # the workers get what is left of the caller's budget, here nothing
+        import random
+        import time
+        random.seed(3)
+        x = ''.join(random.choice('abcd') for i in range(300))
+        y = ''.join(c if i % 15 else 'q' for i, c in enumerate(x))
+        texts = [({'s':x}, {'s':y}, None)]
+        def late(f):
+            time.sleep(0.3)
+            return f()
+        d = differ(budget=0.2)
+        serial = d.run(late, lambda: [diff(a, b, p) for a, b, p in texts])
+        self.assertEqual(d.run(late, lambda: diff_many(texts, processes=1)), serial)
+        self.assertNotEqual(diff_many(texts, processes=1), serial)
+
+    def test_op_stats(self):
+        stats = op_stats()
+        d = differ({'attributes':{'n':{'otype':'integer'}}}, stats=stats)
+        a = {'o':{'s':'abc', 'x':1}, 'n':1, 'same':[1]}
+        b = {'o':{'s':'abd', 'x':2}, 'n':2, 'same':[1]}
+        ops = d.diff(a, b)['v']
+        d.apply_diff(a, ops)
+        d.transform_object_diff(ops, {'n':{'o':'I', 'v':5}}, a)
+
+        calls = dict(((r[0], r[1]), r[2]) for r in stats.report())
+        self.assertEqual(calls, {
+            ('diff', 'O'):2, ('diff', 'd'):1, ('diff', 'r'):1, ('diff', 'I'):1,
+            ('apply', 'O'):1, ('apply', 'd'):1, ('apply', 'r'):1, ('apply', 'I'):1,
+            ('transform', 'I'):1})
+        for phase, otype, n, seconds in stats.report():
+            self.assertTrue(seconds >= 0)
+
+        # not recorded outside of the differ
+        diff(a, b)
+        self.assertEqual(sum(r[2] for r in stats.report()), 10)
+
+        # a failed op still hands its time back to the op it is nested in
+        import jsondiff
+        jsondiff.SCOPE.nested = 100
+        self.assertRaises(TypeError, d.diff, {'o':{'n':1}}, {'o':{'n':'x'}}, {'attributes':{'o':{'attributes':{'n':{'otype':'integer'}}}}})
+        self.assertTrue(jsondiff.SCOPE.nested >= 100)
+        self.assertEqual(sum(r[2] for r in stats.report()), 10)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -7,7 +7,30 @@ def noop( something ):
 
 __builtins__['reload'] = noop
 
+from diffmatchpatch import diff_match_patch_test as upstream
 from diffmatchpatch.diff_match_patch_test import *
 
+from jsondiff import dmp_patch
+
+# run the upstream suite against the subclass differs use
+class ucs2_setup:
+    def setUp( self ):
+        self.dmp = dmp_patch.diff_match_patch_ucs2()
+
+class DiffTest( ucs2_setup, upstream.DiffTest ):
+    pass
+
+class MatchTest( ucs2_setup, upstream.MatchTest ):
+    pass
+
+class PatchTest( ucs2_setup, upstream.PatchTest ):
+    pass
+
+class UCS2SetupTest( unittest.TestCase ):
+    def testSetUp( self ):
+        test = DiffTest( 'testDiffMain' )
+        test.setUp()
+        self.assertTrue( isinstance( test.dmp, dmp_patch.diff_match_patch_ucs2 ) )
+
 if __name__ == '__main__':
     unittest.main()